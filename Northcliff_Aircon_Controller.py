@@ -13,9 +13,125 @@ import sys
 import spidev
 import math
 import os
+import threading
+import multiprocessing
+
+class LocalSerialTransport(object): # Aircon comms link on a serial port that's wired to this board
+    def __init__(self, port):
+        self.port = serial.Serial(port, 1200, parity=serial.PARITY_EVEN, timeout=0.5)
+        self.link_latency = None # Not measured for a local serial port
+
+    def read(self, size):
+        return self.port.read(size)
+
+    def write(self, data):
+        self.port.write(data)
+
+    def send_packet_1(self, packet): # Send Packet 1 and remove its echo, leaving the link ready to receive Packet 2
+        self.port.flushInput() # remove sent packets from aircon comms buffer
+        self.port.write(packet)
+        time.sleep(0.160) # Wait until Packet 1 has been sent before clearing aircon comms buffer
+        self.port.flushInput() # remove sent packets from aircon comms buffer
+        time.sleep(0.15) # Gap between Packets 1 and 2
+
+    def send_packet_3(self, packet):
+        time.sleep(0.16) # Gap between Packets 2 and 3
+        self.port.write(packet)
+
+class NetworkSerialTransport(LocalSerialTransport): # Aircon comms link through an RFC 2217 or raw TCP serial bridge, e.g. "rfc2217://bridge:4001" or "socket://bridge:4001"
+    def __init__(self, url):
+        self.url = url
+        self.port = None # None while the bridge link is down
+        self.character_time = 11 / 1200 # Start, 8 data, parity and stop bits at 1200 baud
+        self.link_latency = None # Smoothed time in seconds between writing to the bridge and the bridge's echo arriving, excluding serial transmission time
+        self.pending = b"" # Bytes read while looking for the echo that belong to Packet 2
+        self.reconnect_delay = 0.5 # Backoff between bridge connection attempts, doubling up to 10 seconds
+        self.reconnect_time = 0 # Time of the next bridge connection attempt
+        self.connect()
+
+    def connect(self): # Open the bridge link if the backoff allows. Returns True if the link is up
+        if self.port != None:
+            return True
+        if time.time() < self.reconnect_time:
+            return False
+        try:
+            self.port = serial.serial_for_url(self.url, 1200, parity=serial.PARITY_EVEN, timeout=1.0) # Allow for the network round trip
+        except (serial.SerialException, OSError) as error:
+            print("Unable to connect to serial bridge", self.url, error, "Retrying in", self.reconnect_delay, "seconds")
+            self.reconnect_time = time.time() + self.reconnect_delay
+            self.reconnect_delay = min(self.reconnect_delay * 2, 10)
+            return False
+        print("Connected to serial bridge", self.url)
+        self.reconnect_delay = 0.5
+        self.pending = b""
+        return True
+
+    def disconnect(self, error): # Close a failed bridge link so that it's reopened on the next exchange. Reads return nothing until then, which is reported as a missing Packet 2
+        print("Lost serial bridge", self.url, error)
+        try:
+            self.port.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.port = None
+        self.pending = b""
+        self.link_latency = None
+        self.reconnect_time = time.time() + self.reconnect_delay
+
+    def read(self, size):
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        if len(data) < size and self.port != None:
+            try:
+                data += self.port.read(size - len(data))
+            except (serial.SerialException, OSError) as error:
+                self.disconnect(error)
+        return data
+
+    def write(self, data):
+        if self.connect() == False:
+            return
+        try:
+            self.port.write(data)
+        except (serial.SerialException, OSError) as error:
+            self.disconnect(error)
+
+    def send_packet_1(self, packet): # Pipeline the Packet 1 write with the Packet 2 read. Rather than waiting fixed gaps and flushing (each flush is a round trip on RFC 2217),
+        # read back the echo as soon as it arrives and go straight on to reading Packet 2
+        if self.connect() == False:
+            return
+        try:
+            self.port.reset_input_buffer() # remove sent packets from aircon comms buffer
+            self.pending = b""
+            write_time = time.time()
+            self.port.write(packet)
+            echo = self.port.read(1)
+            if echo != packet[:1]: # No echo, so keep whatever was received for Packet 2
+                self.pending = echo
+                return
+            latency = time.time() - write_time - self.character_time
+            if self.link_latency == None:
+                self.link_latency = latency
+            else:
+                self.link_latency += 0.1 * (latency - self.link_latency)
+            echo += self.port.read(len(packet) - 1)
+        except (serial.SerialException, OSError) as error:
+            self.disconnect(error)
+            return
+        if echo != packet: # Keep anything after a partial echo for Packet 2
+            matched_length = 0
+            while matched_length < len(echo) and echo[matched_length] == packet[matched_length]:
+                matched_length += 1
+            self.pending = echo[matched_length:]
+
+    def send_packet_3(self, packet): # Packet 2 reaches this host, and Packet 3 reaches the unit, a round trip later than on a local port, so shorten the gap by the measured latency
+        if self.link_latency == None:
+            time.sleep(0.16) # Gap between Packets 2 and 3
+        else:
+            time.sleep(max(0.16 - self.link_latency, 0))
+        self.write(packet)
 
 class NorthcliffAirconController(object):
-    def __init__(self, calibrate_damper_on_startup):
+    def __init__(self, calibrate_damper_on_startup, isolate_serial_comms = False, aircon_comms_port = "/dev/ttyAMA0"):
         # Set up GPIO
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
@@ -54,6 +170,23 @@ class NorthcliffAirconController(object):
             self.damper_day_position = 416
             self.damper_night_position = 1648
             self.calibrate_damper_on_startup = calibrate_damper_on_startup
+            # Set up central damper motion model. Rates are in sensor units per second in each direction, Stop Latency is the time in seconds for the damper to settle after a stop command
+            # and Coast Distance is the net sensor units travelled beyond the planned run, allowing for the motor's start delay
+            # The model is learned during calibration, refined after every damper move and stored with the controller
+            self.damper_motion_model_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'damper_motion_model.json')
+            self.damper_motion_model = {'Day Rate': None, 'Night Rate': None, 'Stop Latency': 1.0, 'Coast Distance': 0}
+            self.load_damper_motion_model()
+            self.damper_model_learning_rate = 0.3 # Weighting given to each new damper motion observation
+            self.damper_move_corrections = 1 # Number of planned correction moves allowed after the initial planned move
+            self.damper_minimum_run_time = 0.2 # Shortest planned damper motor run in seconds
+            self.damper_maximum_settle_time = 5 # Longest wait in seconds for the damper to settle after a planned move
+            self.damper_move = None # Holds the details of the planned damper move that's underway
+            self.damper_stop_timer = None # Stops the damper motor at the end of a planned move
+            self.damper_move_lock = threading.Lock() # Orders the damper stop timer against the main loop abandoning the move
+            self.damper_target_percent = None # The requested damper percent that the planned moves are aiming for
+            self.damper_planned_moves_remaining = 0
+            self.damper_drive_samples = [] # Damper readings taken while the damper is being driven to the requested position without a plan
+            self.damper_drive_direction = None
             # Set up SPI Port for the central damper position sensor
             self.spi = spidev.SpiDev()
             speed = 50000
@@ -84,6 +217,16 @@ class NorthcliffAirconController(object):
         self.fan_state = 'Off' # Mirrors aircon fan speed
         self.filter = False # Mirrors aircon filter indicator
         
+        # Set up mqtt session
+        self.mqtt_broker_name = "<your mqtt Broker name>"
+        self.mqtt_connected = False # Mirrors the mqtt broker connection state
+        self.mqtt_topic_qos = {'AirconControl': 1, 'AirconStatus': 1} # QoS for each subscribed and published topic
+        self.mqtt_outbox_services = ['Status Update', 'Restart'] # Services that are held in the outbox until they can be published. Other services (e.g. Heartbeats) are
+        # published at QoS 0 and dropped while disconnected because they're stale on reconnection
+        self.mqtt_outbox = {} # Holds only the latest message for each outbox service, so the outbox can't grow while disconnected
+        self.mqtt_outbox_lock = threading.Lock() # The outbox is shared between the main loop and the mqtt thread
+        self.mqtt_max_queued_messages = 1 # paho only holds the outbox message that's being delivered. Later messages wait in the outbox, where they're replaced by newer ones
+
         # Set up heartbeat
         self.heartbeat_count = 0
         self.no_heartbeat_ack = False
@@ -114,7 +257,44 @@ class NorthcliffAirconController(object):
                                     "5Fan3": self.fan_speed['Hi Off'], "6Filler3b": "fffff03fffffffffff"}
         
         # Set up serial port for aircon controller comms
-        self.aircon_comms = serial.Serial("/dev/ttyAMA0", 1200, parity=serial.PARITY_EVEN, timeout=0.5) # After swapping serial and bluetooth ports so we can use parity
+        # Use "/dev/ttyAMA0" after swapping serial and bluetooth ports so we can use parity, or an "rfc2217://" or "socket://" url to use a network serial bridge
+        self.aircon_comms_port = aircon_comms_port
+        self.packet_2_search_time = 1.0 # Longest time in seconds to look for a Packet 2 header
+
+        # Set up isolated serial comms. When enabled, the Packet 1/2/3 exchange runs in its own process so that its timing doesn't share the GIL with mqtt, json and logging
+        self.isolate_serial_comms = isolate_serial_comms
+        if self.isolate_serial_comms:
+            self.serial_comms_core = 3 # CPU core that the serial comms process is pinned to
+            self.serial_comms_priority = 50 # SCHED_FIFO priority of the serial comms process
+            self.serial_comms_context = multiprocessing.get_context('spawn') # Start the serial comms process without copying the main process's threads and locks. It opens its own aircon comms link
+            self.packet_body_length = 13 # Number of Packet 1 and Packet 3 bytes between the header and the checksum
+            # Shared desired state block holding the Packet 1 and Packet 3 bodies. Written by the main process and read by the serial comms process
+            self.shared_desired_state = self.serial_comms_context.Array('B', 2 * self.packet_body_length, lock = False)
+            self.shared_desired_state_sequence = self.serial_comms_context.Value('L', 0, lock = False) # Odd while the desired state block is being written
+            self.shared_serial_enable = self.serial_comms_context.Value('b', False, lock = False) # Mirrors enable_serial_comms_loop for the serial comms process
+            self.shared_serial_exchange_active = self.serial_comms_context.Value('b', False, lock = False) # True while the serial comms process is part way through an exchange
+            # Telemetry ring holding received Packet 2s. Each slot has a no header flag followed by the 16 Packet 2 bytes. Only written by the serial comms process
+            self.telemetry_ring_slots = 8
+            self.telemetry_slot_length = 17
+            self.shared_telemetry_ring = self.serial_comms_context.Array('B', self.telemetry_ring_slots * self.telemetry_slot_length, lock = False)
+            self.shared_telemetry_write_count = self.serial_comms_context.Value('L', 0, lock = False)
+            self.telemetry_read_count = 0
+            self.shared_link_latency = self.serial_comms_context.Value('d', -1, lock = False) # Aircon comms link latency measured by the serial comms process. Negative if not measured
+        else:
+            self.aircon_comms = self.open_aircon_comms()
+
+    def open_aircon_comms(self):
+        if '://' in self.aircon_comms_port:
+            return NetworkSerialTransport(self.aircon_comms_port)
+        else:
+            return LocalSerialTransport(self.aircon_comms_port)
+
+    def aircon_comms_link_latency(self): # Returns the measured aircon comms link latency in seconds, or None if it isn't measured
+        if self.isolate_serial_comms:
+            if self.shared_link_latency.value < 0:
+                return None
+            return self.shared_link_latency.value
+        return self.aircon_comms.link_latency
 
     def print_status(self, print_message):
         today = datetime.now()
@@ -124,11 +304,14 @@ class NorthcliffAirconController(object):
     def startup(self):        
         self.print_status("Northcliff Aircon Controller starting up on ")
         # Set up mqtt client
-        self.client = mqtt.Client('aircon') #Create new instance of mqtt Class
+        self.client = mqtt.Client('aircon', clean_session = False) #Create new instance of mqtt Class with a persistent session so that the broker keeps subscriptions and queued commands while disconnected
         self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
-        self.client.connect("<your mqtt Broker name>", 1883, 60) #Connect to mqtt broker
-        self.client.loop_start() #Start mqtt monitor thread
+        self.client.reconnect_delay_set(min_delay = 0.2, max_delay = 0.8) # Reconnect with exponential backoff, capped so that control resumes within a second of the broker restarting
+        self.client.max_queued_messages_set(self.mqtt_max_queued_messages) # Bound paho's own queue of unacknowledged messages
+        self.client.connect_async(self.mqtt_broker_name, 1883, 60) #Connect to mqtt broker without blocking startup
+        self.client.loop_start() #Start mqtt monitor thread, which also handles connection and reconnection
         # Allow for central damper calibration if there are no room dampers
         if self.damper_rooms == {} and self.calibrate_damper_on_startup == True:
             self.calibrate_damper(damper_movement_time = 180)
@@ -136,11 +319,42 @@ class NorthcliffAirconController(object):
             self.detect_damper_position(calibrate = False)
         self.update_status()
 
-    def on_connect(self, client, userdata, flags, rc): # Print mqtt status on connecting to broker
-        time.sleep(1)
+    def on_connect(self, client, userdata, flags, rc): # Print mqtt status, subscribe and flush the outbox on connecting to broker
         self.print_status("Connected to mqtt server with result code "+str(rc)+" on ")
         print("")
-        self.client.subscribe("AirconControl")
+        if rc == 0:
+            self.client.subscribe("AirconControl", qos = self.mqtt_topic_qos['AirconControl'])
+            with self.mqtt_outbox_lock:
+                self.mqtt_connected = True
+                self.publish_held_mqtt_messages() # Publish the messages held while disconnected
+
+    def on_disconnect(self, client, userdata, rc): # Flag the disconnection so that messages are held in the outbox until reconnection
+        with self.mqtt_outbox_lock:
+            self.mqtt_connected = False
+        if rc != 0:
+            self.print_status("Unexpectedly disconnected from mqtt server with result code "+str(rc)+". Reconnecting on ")
+
+    def publish_mqtt_message(self, topic, payload): # Publish outbox services through the outbox and other services at QoS 0 if connected
+        service = json.loads(payload)['service']
+        with self.mqtt_outbox_lock:
+            if service in self.mqtt_outbox_services:
+                self.mqtt_outbox[(topic, service)] = payload # Replace any older message for the same service
+                if self.mqtt_connected:
+                    self.publish_held_mqtt_messages()
+            elif self.mqtt_connected:
+                self.client.publish(topic, payload, qos = 0)
+
+    def flush_mqtt_outbox(self): # Called from the main loop to publish messages that were held while paho was delivering an earlier one
+        with self.mqtt_outbox_lock:
+            if self.mqtt_connected:
+                self.publish_held_mqtt_messages()
+
+    def publish_held_mqtt_messages(self): # Hand outbox messages to paho until its queue is full. Must be called with the outbox lock held
+        for (topic, service) in list(self.mqtt_outbox):
+            result = self.client.publish(topic, self.mqtt_outbox[(topic, service)], qos = self.mqtt_topic_qos[topic])
+            if result.rc == mqtt.MQTT_ERR_QUEUE_SIZE: # paho is still delivering an earlier message, so keep the rest for the next attempt
+                return
+            del self.mqtt_outbox[(topic, service)] # Published, or queued by paho for delivery on reconnection if the disconnection hasn't been detected yet
 
     def on_message(self, client, userdata, msg): # mqtt message method calls
         decoded_payload = str(msg.payload.decode("utf-8"))
@@ -198,7 +412,7 @@ class NorthcliffAirconController(object):
                                  'Compressor': self.compressor, 'Malfunction': self.malfunction, 'Damper': 50, 'Filter': self.filter,
                                  'Room Damper States': self.room_damper_states})
         #print('Update Status', status)
-        self.client.publish('AirconStatus', status)
+        self.publish_mqtt_message('AirconStatus', status)
 
     ### Methods for mqtt messages received from Home Manager ###
     def process_thermo_off_command(self):
@@ -439,16 +653,21 @@ class NorthcliffAirconController(object):
         if self.heartbeat_count == 120:
             #self.print_status('Sending Heartbeat to Home Manager on ')
             self.send_heartbeat_to_home_manager()
+            link_latency = self.aircon_comms_link_latency()
+            if link_latency != None: # Report the network serial bridge latency
+                print("Aircon comms link latency is", round(link_latency * 1000), "ms")
         if self.heartbeat_count > 200:
             self.print_status('Home Manager Heartbeat Lost. Setting Aircon to Thermo Off Mode on ')
-            self.client.publish('AirconStatus', '{"service": "Restart"}')
+            self.publish_mqtt_message('AirconStatus', '{"service": "Restart"}')
             self.no_heartbeat_ack = True
             self.process_thermo_off_command()
-            time.sleep(10)
+            for wait in range(10): # Allow time for the held Restart and Status Update messages to be published
+                time.sleep(1)
+                self.flush_mqtt_outbox()
             os.system('sudo reboot')
 
     def send_heartbeat_to_home_manager(self):
-        self.client.publish('AirconStatus', '{"service": "Heartbeat"}')
+        self.publish_mqtt_message('AirconStatus', '{"service": "Heartbeat"}')
 
     def build_packets(self, packet_1, packet_3): # Build packets 1 and 3 for sending to the aircon
         packets = [packet_1, packet_3]
@@ -465,14 +684,27 @@ class NorthcliffAirconController(object):
                 self.packet_3_with_checksum = packet_with_checksum
                 self.packet_3_send = packet_send
 
-    def send_serial_aircon_data(self, packet): # Send packet to aircon comms port
-        self.aircon_comms.write(packet)
+    def receive_serial_aircon_data(self): # Receive Packet 2 from aircon comms port and decode it
+        self.raw_response = self.read_serial_packet_2()
+        if self.raw_response != None: # Decode Packet 2 if the correct Packet 2 header was found
+            self.packet_2 = str(binascii.hexlify(self.raw_response), "utf-8") # Convert Packet to to a string
+            self.decode_packet(self.packet_2) # Extract each component of Packet 2 and place in a dictionary that decodes the aircon function of each packet byte
+        else: # Flag that no correct Packet 2 header has been found
+            print("No valid Packet 2 Header received")
+            self.packet_2_error = True
+            self.flag_serial_comms_malfunction()
+
+    def flag_serial_comms_malfunction(self): # Flag a malfunction and update Home Manager if it's new
+        if self.malfunction == False:
+            self.malfunction = True
+            self.update_status()
 
-    def receive_serial_aircon_data(self): # Receive Packet 2 from aircon comms port 
+    def read_serial_packet_2(self): # Read Packet 2 from aircon comms port. Returns None if no valid Packet 2 header is found
         # Look for Packet 2 Header (x808c)
         header_loop_count = 0
         found_packet_2_header = False
-        while header_loop_count < 16: # Test an entire packet for header
+        search_start = time.time()
+        while header_loop_count < 16 and time.time() - search_start < self.packet_2_search_time: # Test an entire packet for header, limiting the total time spent so that read timeouts can't stall the cycle
             test_for_header_1 = self.aircon_comms.read(1) # Read one byte to look for the first half of the header
             if test_for_header_1 == b'\x80':
                 test_for_header_2 = self.aircon_comms.read(1) # Read one byte to look for the second half of the header, after sucessfully finding the first half of the header
@@ -487,13 +719,9 @@ class NorthcliffAirconController(object):
         if found_packet_2_header == True: # Read the remaining bytes in the packet after the correct Packet 2 Header is found
             self.raw_response_1 = self.aircon_comms.read(6) # Capture the next 6 bytes
             self.raw_response_2 = self.aircon_comms.read(8) # capture the next 8 bytes
-            self.raw_response = b"".join([test_for_header_1, test_for_header_2, self.raw_response_1, self.raw_response_2]) # Construct the entire Packet 2 in binary form
-            self.packet_2 = str(binascii.hexlify(self.raw_response), "utf-8") # Convert Packet to to a string
-            self.decode_packet(self.packet_2) # Extract each component of Packet 2 and place in a dictionary that decodes the aircon function of each packet byte
-        else: # Flag that no correct Packet 2 header has been found
-            print("No valid Packet 2 Header received")
-            self.packet_2_error = True
-            self.malfunction = True
+            return b"".join([test_for_header_1, test_for_header_2, self.raw_response_1, self.raw_response_2]) # Construct the entire Packet 2 in binary form
+        else:
+            return None
             
     def decode_packet(self, packet_2): # Extract each component of Packet 2 and place in a dictionary that decodes the aircon function of each packet byte. Validate checksum and comparison with Packet 1 data
         self.packet_2_error = False # Flag that Packet 2 is OK
@@ -578,6 +806,66 @@ class NorthcliffAirconController(object):
         next_string = hex(next_first_byte)[2:].zfill(2) + hex(next_third_nibble)[2:] + "f" # Combine the first byte and third nibble in string form, adding hex f at the end to make it two complete bytes
         return next_string
 
+    ### Isolated serial comms methods ###
+    def start_serial_comms_process(self): # Start the process that runs the Packet 1/2/3 exchange
+        serial_comms_settings = {'Port': self.aircon_comms_port, 'Packet 2 Search Time': self.packet_2_search_time, 'Core': self.serial_comms_core,
+                                 'Priority': self.serial_comms_priority, 'Packet 1 Header': self.packet1_header, 'Packet 3 Initial Header': self.packet3_initial_header,
+                                 'Packet Body Length': self.packet_body_length, 'Telemetry Ring Slots': self.telemetry_ring_slots,
+                                 'Telemetry Slot Length': self.telemetry_slot_length, 'Parent PID': os.getpid()}
+        self.serial_comms_process = self.serial_comms_context.Process(target = run_isolated_serial_exchange, name = 'aircon serial comms', daemon = True,
+                                                                      args = (serial_comms_settings, self.shared_desired_state, self.shared_desired_state_sequence,
+                                                                              self.shared_serial_enable, self.shared_serial_exchange_active, self.shared_telemetry_ring,
+                                                                              self.shared_telemetry_write_count, self.shared_link_latency))
+        self.serial_comms_process.start()
+        print("Started isolated serial comms process", self.serial_comms_process.pid)
+        try: # Keep the main process and its threads off the serial comms core so that they can't be starved by, or delay, the real-time process
+            os.sched_setaffinity(0, os.sched_getaffinity(0) - {self.serial_comms_core})
+        except (OSError, ValueError) as error:
+            print("Unable to move main process off core", self.serial_comms_core, error)
+
+    def check_serial_comms_process(self): # Restart the serial comms process if it has died, flagging a malfunction
+        if self.serial_comms_process.is_alive() == False:
+            self.print_status("Isolated serial comms process stopped with exit code " + str(self.serial_comms_process.exitcode) + ". Restarting on ")
+            self.shared_serial_exchange_active.value = False
+            if self.malfunction == False:
+                self.malfunction = True
+                self.update_status()
+            self.start_serial_comms_process()
+
+    def stop_serial_comms_process(self):
+        self.serial_comms_process.terminate()
+        self.serial_comms_process.join(1)
+
+    def write_shared_desired_state(self): # Publish the Packet 1 and Packet 3 bodies to the serial comms process
+        self.shared_desired_state_sequence.value += 1 # Flag that a write is in progress
+        self.shared_desired_state[:self.packet_body_length] = bytes.fromhex(self.packet_1_with_checksum[4:30])
+        self.shared_desired_state[self.packet_body_length:] = bytes.fromhex(self.packet_3_with_checksum[4:30])
+        self.shared_desired_state_sequence.value += 1 # Flag that the write is complete
+
+    def receive_serial_telemetry(self): # Decode the Packet 2s received by the serial comms process, waiting up to one exchange cycle for a new one
+        wait_start = time.time()
+        while self.shared_telemetry_write_count.value == self.telemetry_read_count and time.time() - wait_start < 1.5:
+            time.sleep(0.02)
+        write_count = self.shared_telemetry_write_count.value
+        if write_count == self.telemetry_read_count:
+            print("No Packet 2 received from serial comms process")
+            self.flag_serial_comms_malfunction()
+        self.telemetry_read_count = max(self.telemetry_read_count, write_count - self.telemetry_ring_slots + 1) # Skip any slots that have been, or are being, overwritten
+        while self.telemetry_read_count < write_count:
+            slot_start = (self.telemetry_read_count % self.telemetry_ring_slots) * self.telemetry_slot_length
+            slot = bytes(self.shared_telemetry_ring[slot_start:slot_start + self.telemetry_slot_length])
+            self.telemetry_read_count += 1
+            if self.shared_telemetry_write_count.value - self.telemetry_read_count >= self.telemetry_ring_slots - 1: # Discard the slot if the serial comms process started overwriting it while it was being read
+                continue
+            if slot[0] == 0:
+                self.packet_2 = str(binascii.hexlify(slot[1:]), "utf-8")
+                self.decode_packet(self.packet_2)
+            else:
+                print("No valid Packet 2 Header received")
+                self.packet_2_error = True
+                self.flag_serial_comms_malfunction()
+    ### End of isolated serial comms methods ###
+
     def detect_damper_position(self, calibrate):
         resp2 = self.spi.xfer2([0x11, 0x00, 0x00])
         resp2a = int(resp2.pop(1)/2) # Remove LSB since we only need 10% resolution
@@ -610,16 +898,41 @@ class NorthcliffAirconController(object):
                 self.reported_damper_percent = 0
 
     def adjust_damper_position(self): 
-        if self.requested_damper_percent != self.reported_damper_percent:    
+        reading_time = time.time()
+        if self.damper_move != None: # Follow the planned damper move that's underway
+            self.follow_damper_move(reading_time)
+        elif self.requested_damper_percent != self.reported_damper_percent:    
             self.adjusting_damper = True
             if self.requested_damper_percent > self.reported_damper_percent:
+                direction = 'Day'
+            else:
+                direction = 'Night'
+            if self.requested_damper_percent != self.damper_target_percent: # Allow an initial planned move plus corrections for each new damper request
+                self.damper_target_percent = self.requested_damper_percent
+                self.damper_planned_moves_remaining = 1 + self.damper_move_corrections
+            if self.damper_drive_samples == [] and self.plan_damper_move(direction, reading_time):
+                return
+            # Drive the damper until the reported position matches if the move can't be planned (e.g. the motion model hasn't been learned yet,
+            # the damper is to be wholly in one zone or the planned moves have been used)
+            if direction != self.damper_drive_direction: # Learn from the previous drive if the damper has overshot and is changing direction
+                self.learn_damper_travel_rate(self.damper_drive_direction, self.damper_drive_samples)
+                self.damper_drive_samples = []
+                self.damper_drive_direction = direction
+            self.damper_drive_samples.append((reading_time, self.damper_position))
+            if direction == 'Day':
                 self.damper_day_zone() # Set damper switch to day zone if the damper's to be moved towards the day zone
             else:
-                self.requested_damper_percent < self.reported_damper_percent
                 self.damper_night_zone() # Set damper switch to night zone if the damper's to be moved towards the night zone
         else:
             if self.adjusting_damper == True: # Flag that the damper is no longer being adjusted if it was previously being adjusted
                 self.adjusting_damper = False
+                self.damper_target_percent = None
+                if self.damper_drive_samples != []:
+                    self.damper_drive_samples.append((reading_time, self.damper_position))
+                    self.learn_damper_travel_rate(self.damper_drive_direction, self.damper_drive_samples)
+                    self.save_damper_motion_model()
+                    self.damper_drive_samples = []
+                    self.damper_drive_direction = None
                 self.update_status()
             if self.requested_damper_percent == 100: # Lock damper in Day Zone if the damper is to be wholly in Day Zone
                 self.damper_day_zone()
@@ -628,6 +941,103 @@ class NorthcliffAirconController(object):
             else:
                 self.hold_damper() # Hold damper in position if the damper is to be between zones
 
+    def plan_damper_move(self, direction, reading_time): # Start a timed damper move that uses the motion model to stop the motor early. Returns False if the move can't be planned
+        travel_rate = self.damper_motion_model[direction + ' Rate']
+        if travel_rate == None or self.requested_damper_percent in (0, 100) or self.damper_planned_moves_remaining == 0:
+            return False
+        target_position = self.damper_night_position - self.requested_damper_percent * (self.damper_night_position - self.damper_day_position) / 100
+        distance = abs(target_position - self.damper_position)
+        run_time = max((distance - self.damper_motion_model['Coast Distance']) / travel_rate, self.damper_minimum_run_time)
+        self.damper_planned_moves_remaining -= 1
+        print('Planned', direction, 'Zone Damper Move of', round(run_time, 2), 'seconds from', self.damper_position, 'towards', int(target_position))
+        self.damper_move = {'Direction': direction, 'Start Time': reading_time, 'Start Position': self.damper_position, 'Run Time': run_time,
+                            'Samples': [], 'Stop Time': None, 'Settle Samples': []}
+        if direction == 'Day':
+            self.damper_day_zone()
+        else:
+            self.damper_night_zone()
+        self.damper_stop_timer = threading.Timer(run_time, self.stop_damper_move, args = [self.damper_move]) # Stop the motor at the planned time, independently of the serial comms cycle
+        self.damper_stop_timer.daemon = True # Don't keep the controller running on shutdown
+        self.damper_stop_timer.start()
+        return True
+
+    def stop_damper_move(self, move): # Called by the damper stop timer at the end of a planned move
+        with self.damper_move_lock:
+            if self.damper_move is move: # Ignore the timer if the move has been abandoned
+                self.hold_damper()
+                move['Stop Time'] = time.time()
+
+    def cancel_damper_move(self): # Abandon any planned damper move that's underway. Once this returns, the damper stop timer can't drive the damper
+        with self.damper_move_lock:
+            stop_timer = self.damper_stop_timer
+            self.damper_stop_timer = None
+            self.damper_move = None
+        if stop_timer != None:
+            stop_timer.cancel()
+            stop_timer.join() # Wait for a timer that had already fired, which then finds the move abandoned
+        self.damper_target_percent = None
+        self.damper_drive_samples = []
+        self.damper_drive_direction = None
+
+    def follow_damper_move(self, reading_time): # Capture readings during a planned damper move and update the motion model once the damper has settled
+        move = self.damper_move
+        stop_time = move['Stop Time']
+        if stop_time == None: # Still travelling
+            move['Samples'].append((reading_time, self.damper_position))
+            return
+        move['Settle Samples'].append((reading_time, self.damper_position))
+        settle_samples = move['Settle Samples']
+        settled = len(settle_samples) > 1 and settle_samples[-1][1] == settle_samples[-2][1] and reading_time - stop_time >= self.damper_motion_model['Stop Latency']
+        if settled == False and reading_time - stop_time < self.damper_maximum_settle_time:
+            return
+        # Learn from the completed move
+        self.damper_stop_timer = None
+        self.damper_move = None
+        self.learn_damper_travel_rate(move['Direction'], [(move['Start Time'], move['Start Position'])] + move['Samples'])
+        travel_rate = self.damper_motion_model[move['Direction'] + ' Rate']
+        final_position = self.damper_position
+        coast_distance = abs(final_position - move['Start Position']) - travel_rate * move['Run Time']
+        self.damper_motion_model['Coast Distance'] = self.learn_damper_parameter(self.damper_motion_model['Coast Distance'], coast_distance)
+        if settled == True:
+            settle_time = [sample_time for (sample_time, position) in settle_samples if position == final_position][0] - stop_time # First reading at the settled position
+            self.damper_motion_model['Stop Latency'] = self.learn_damper_parameter(self.damper_motion_model['Stop Latency'], settle_time)
+        self.save_damper_motion_model()
+        print('Planned Damper Move finished at', final_position, 'Reported Damper Percent is', self.reported_damper_percent, 'Requested Damper Percent is', self.requested_damper_percent)
+        if self.requested_damper_percent == self.reported_damper_percent:
+            self.adjust_damper_position() # Flag that the damper is no longer being adjusted
+        elif self.damper_planned_moves_remaining == 0:
+            print('Damper Position not reached after correction. Driving to the Requested Damper Percent')
+
+    def learn_damper_travel_rate(self, direction, samples): # Refine a travel rate from readings taken while the damper was being driven in one direction
+        moving_samples = [sample for sample in samples if sample[1] != samples[0][1]]
+        if direction == None or len(moving_samples) < 2:
+            return # Not enough movement to measure
+        first_moving_sample = moving_samples[0]
+        last_moving_sample = [sample for sample in moving_samples if sample[1] == moving_samples[-1][1]][0] # Ignore readings taken at an end stop
+        if last_moving_sample[0] > first_moving_sample[0] and last_moving_sample[1] != first_moving_sample[1]:
+            travel_rate = abs(last_moving_sample[1] - first_moving_sample[1]) / (last_moving_sample[0] - first_moving_sample[0])
+            self.damper_motion_model[direction + ' Rate'] = self.learn_damper_parameter(self.damper_motion_model[direction + ' Rate'], travel_rate)
+
+    def learn_damper_parameter(self, current_value, observed_value): # Blend a new observation into a motion model parameter
+        if current_value == None:
+            return observed_value
+        return current_value + self.damper_model_learning_rate * (observed_value - current_value)
+
+    def load_damper_motion_model(self):
+        try:
+            with open(self.damper_motion_model_file, 'r') as f:
+                self.damper_motion_model.update(json.load(f))
+            print('Loaded Damper Motion Model', self.damper_motion_model)
+        except (OSError, ValueError):
+            print('No Damper Motion Model found. Damper moves will be learned before being planned')
+
+    def save_damper_motion_model(self):
+        try:
+            with open(self.damper_motion_model_file, 'w') as f:
+                json.dump(self.damper_motion_model, f)
+        except OSError as error:
+            print('Unable to save Damper Motion Model', error)
+
     def damper_day_zone(self): # Move damper towards the Day Zone
         self.damper_stop_state = False
         GPIO.output(self.damper_stop, False)
@@ -652,7 +1062,7 @@ class NorthcliffAirconController(object):
         time.sleep(1)
         print('Moving Damper to Night Zone')
         self.damper_night_zone()
-        time.sleep(damper_movement_time)
+        self.time_damper_travel('Night', damper_movement_time)
         print('Moved Damper to Night Zone')
         self.detect_damper_position(calibrate = True)
         print('Night Zone Damper Position', self.damper_position)
@@ -660,7 +1070,7 @@ class NorthcliffAirconController(object):
         self.damper_night_position = self.damper_position
         print('Moving Damper to Day Zone')
         self.damper_day_zone()
-        time.sleep(damper_movement_time)
+        self.time_damper_travel('Day', damper_movement_time)
         print('Moved Damper to Day Zone')
         self.detect_damper_position(calibrate = True)
         print('Day Zone Damper Position', self.damper_position)
@@ -670,12 +1080,27 @@ class NorthcliffAirconController(object):
         self.damper_control_state = False # Flag that the damper is no longer being controlled
         GPIO.output(self.damper_control, False) # Relinquish Control of Damper
         time.sleep(1)
+        print('Damper Motion Model', self.damper_motion_model)
+        self.save_damper_motion_model()
+
+    def time_damper_travel(self, direction, damper_movement_time): # Sample the damper position while it travels during calibration to learn its travel rate
+        samples = []
+        movement_start = time.time()
+        while time.time() - movement_start < damper_movement_time:
+            self.detect_damper_position(calibrate = True)
+            samples.append((time.time(), self.damper_position))
+            time.sleep(0.5)
+        self.learn_damper_travel_rate(direction, samples)
 
     def shutdown_cleanup(self):
         self.print_status("Northcliff Aircon Controller shutting down on ")
         self.process_thermo_off_command() #Turn Aircon off
+        if self.damper_rooms == {}: # Abandon any planned central damper move before releasing the GPIO
+            self.cancel_damper_move()
         GPIO.cleanup()
         self.client.loop_stop() #Stop monitoring mqtt thread
+        if self.isolate_serial_comms:
+            self.stop_serial_comms_process()
         if self.damper_rooms != {}: # Stop spi interface if there are no room dampers
             self.spi.close()
         sys.exit(0)
@@ -699,20 +1124,27 @@ class NorthcliffAirconController(object):
     ### Main Loop ###  
     def run(self):
         try:
+            if self.isolate_serial_comms:
+                self.start_serial_comms_process()
             self.startup()
             while True:
                 self.process_home_manager_heartbeat() # Send heartbeat to Home Manager every 120 loops.
-                if self.enable_serial_comms_loop == True: 
-                    self.aircon_comms.flushInput() # remove sent packets from aircon comms buffer
+                self.flush_mqtt_outbox() # Publish any messages held in the mqtt outbox
+                if self.enable_serial_comms_loop == True and self.isolate_serial_comms == True:
+                    self.check_serial_comms_process() # Restart the serial comms process if it has died
+                    self.build_packets(self.packet_1_dictionary, self.packet_3_dictionary) # Build Packets 1 and 3
+                    self.write_shared_desired_state() # Pass the Packet 1 and 3 bodies to the serial comms process
+                    self.shared_serial_enable.value = True
+                    self.receive_serial_telemetry() # Wait for and decode Packet 2
+                    if self.damper_rooms == {}: # Only detect and adjust central damper position if there are no room dampers
+                        self.detect_damper_position(calibrate = False) # Determine the damper's current position
+                        self.adjust_damper_position() # Adjusts damper central position if the current damper position is different from the requested damper position
+                elif self.enable_serial_comms_loop == True: 
                     self.build_packets(self.packet_1_dictionary, self.packet_3_dictionary) # Build Packets 1 and 3
-                    self.send_serial_aircon_data(self.packet_1_send) # Send Packet 1 to aircon comms port
-                    time.sleep(0.160) # Wait until Packet 1 has been sent before clearing aircon comms buffer
-                    self.aircon_comms.flushInput() # remove sent packets from aircon comms buffer
-                    time.sleep(0.15) # Gap between Packets 1 and 2
+                    self.aircon_comms.send_packet_1(self.packet_1_send) # Send Packet 1 to aircon comms port
                     self.receive_serial_aircon_data() # Receive Packet 2 and decode it
                     if self.packet_2_error == False: #Only send packet 3 if packet 2 was OK
-                        time.sleep(0.16) # Gap between Packets 2 and 3
-                        self.send_serial_aircon_data(self.packet_3_send) # Send Packet 3
+                        self.aircon_comms.send_packet_3(self.packet_3_send) # Send Packet 3
                         self.packet_3_dictionary["1Header3"] = self.calculate_next_sequence_number(self.packet_3_dictionary["1Header3"]) # Set up the sequence number for the next transmission of Packet 3
                     else:
                         print("Packet 3 not sent because of Packet 2 error")
@@ -722,10 +1154,15 @@ class NorthcliffAirconController(object):
                         self.adjust_damper_position() # Adjusts damper central position if the current damper position is different from the requested damper position
                 else:
                     if self.remote_operation_on == True: # This ensures that the disconnect is only done once
+                        if self.isolate_serial_comms == True: # Stop the serial comms process and wait for it to complete its current exchange
+                            self.shared_serial_enable.value = False
+                            while self.shared_serial_exchange_active.value == True and self.serial_comms_process.is_alive():
+                                time.sleep(0.05)
                         self.remote_operation_on = False # Flag that the aircon is not being controlled
                         GPIO.output(self.control_enable, False) # Relinquish Control of the aircon
                         # Reset damper controls
                         if self.damper_rooms == {}: # If central damper
+                            self.cancel_damper_move() # Abandon any planned damper move
                             self.damper_control_state = False # Flag that the damper is no longer being controlled
                             GPIO.output(self.damper_control, False) # Relinquish Control of Damper
                             self.damper_day_zone() # Turn Damper Zone and Stop relays Off
@@ -743,7 +1180,104 @@ class NorthcliffAirconController(object):
             self.shutdown_cleanup()
     ### End of Main Loop ###
 
+class IsolatedSerialExchange(object): # Runs the Packet 1/2/3 exchange in the serial comms process. Only uses its own aircon comms link and the shared memory blocks
+    # Share the controller's packet methods
+    calculate_checksum = NorthcliffAirconController.calculate_checksum
+    calculate_next_sequence_number = NorthcliffAirconController.calculate_next_sequence_number
+    read_serial_packet_2 = NorthcliffAirconController.read_serial_packet_2
+
+    def __init__(self, settings, shared_desired_state, shared_desired_state_sequence, shared_serial_enable, shared_serial_exchange_active,
+                 shared_telemetry_ring, shared_telemetry_write_count, shared_link_latency):
+        self.aircon_comms_port = settings['Port']
+        self.packet_2_search_time = settings['Packet 2 Search Time']
+        self.serial_comms_core = settings['Core']
+        self.serial_comms_priority = settings['Priority']
+        self.packet1_header = settings['Packet 1 Header']
+        self.packet3_initial_header = settings['Packet 3 Initial Header']
+        self.packet_body_length = settings['Packet Body Length']
+        self.telemetry_ring_slots = settings['Telemetry Ring Slots']
+        self.telemetry_slot_length = settings['Telemetry Slot Length']
+        self.parent_pid = settings['Parent PID']
+        self.shared_desired_state = shared_desired_state
+        self.shared_desired_state_sequence = shared_desired_state_sequence
+        self.shared_serial_enable = shared_serial_enable
+        self.shared_serial_exchange_active = shared_serial_exchange_active
+        self.shared_telemetry_ring = shared_telemetry_ring
+        self.shared_telemetry_write_count = shared_telemetry_write_count
+        self.shared_link_latency = shared_link_latency
+        self.previous_desired_state = None
+
+    def run(self): # Serial comms process loop
+        try:
+            self.set_real_time_scheduling()
+            if '://' in self.aircon_comms_port:
+                self.aircon_comms = NetworkSerialTransport(self.aircon_comms_port)
+            else:
+                self.aircon_comms = LocalSerialTransport(self.aircon_comms_port)
+            packet_3_header = self.packet3_initial_header
+            while True:
+                if os.getppid() != self.parent_pid: # Stop driving the aircon if the main process has gone without shutting this process down
+                    print("Main process has stopped. Stopping isolated serial comms process")
+                    return
+                self.shared_serial_exchange_active.value = True # Flag the exchange before checking that it's enabled, so that the main process can't miss it
+                if self.shared_serial_enable.value == True:
+                    desired_state = self.read_shared_desired_state()
+                    packet_1_no_checksum = self.packet1_header + str(binascii.hexlify(desired_state[:self.packet_body_length]), "utf-8")
+                    packet_3_no_checksum = packet_3_header + str(binascii.hexlify(desired_state[self.packet_body_length:]), "utf-8")
+                    self.aircon_comms.send_packet_1(bytes.fromhex(packet_1_no_checksum + self.calculate_checksum(packet_1_no_checksum))) # Send Packet 1 to aircon comms port
+                    raw_response = self.read_serial_packet_2()
+                    self.write_serial_telemetry(raw_response)
+                    if raw_response != None and len(raw_response) == 16 and self.calculate_checksum(str(binascii.hexlify(raw_response[:15]), "utf-8")) == str(binascii.hexlify(raw_response[15:]), "utf-8"): # Only send packet 3 if packet 2 was OK
+                        self.aircon_comms.send_packet_3(bytes.fromhex(packet_3_no_checksum + self.calculate_checksum(packet_3_no_checksum))) # Send Packet 3
+                        packet_3_header = self.calculate_next_sequence_number(packet_3_header) # Set up the sequence number for the next transmission of Packet 3
+                    time.sleep(0.45) # Wait until Packet 3 has been sent, plus 0.05 sec gap (or equivalent time if it isn't sent)
+                    if self.aircon_comms.link_latency == None:
+                        self.shared_link_latency.value = -1
+                    else:
+                        self.shared_link_latency.value = self.aircon_comms.link_latency
+                    self.shared_serial_exchange_active.value = False
+                else:
+                    self.shared_serial_exchange_active.value = False
+                    time.sleep(0.1)
+        except KeyboardInterrupt: # The main process handles the shutdown
+            pass
+
+    def set_real_time_scheduling(self): # Pin the serial comms process to its core and give it real-time scheduling priority
+        try:
+            os.sched_setaffinity(0, {self.serial_comms_core})
+        except (OSError, ValueError) as error:
+            print("Unable to pin serial comms process to core", self.serial_comms_core, error)
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.serial_comms_priority))
+        except (OSError, AttributeError) as error:
+            print("Unable to set real-time priority for serial comms process", error)
+
+    def read_shared_desired_state(self): # Read a consistent copy of the Packet 1 and Packet 3 bodies, retrying if a write was in progress
+        retries = 0
+        while True:
+            sequence = self.shared_desired_state_sequence.value
+            if sequence % 2 == 0:
+                desired_state = bytes(self.shared_desired_state[:])
+                if self.shared_desired_state_sequence.value == sequence:
+                    self.previous_desired_state = desired_state
+                    return desired_state
+            retries += 1
+            if retries >= 20 and self.previous_desired_state != None: # Use the previous copy rather than hold up the exchange
+                return self.previous_desired_state
+            time.sleep(0.001) # Block rather than spin so that the writer can finish
+
+    def write_serial_telemetry(self, raw_response): # Add a received Packet 2 to the telemetry ring
+        slot_start = (self.shared_telemetry_write_count.value % self.telemetry_ring_slots) * self.telemetry_slot_length
+        if raw_response != None:
+            self.shared_telemetry_ring[slot_start:slot_start + self.telemetry_slot_length] = b"\x00" + raw_response[:16].ljust(16, b"\x00")
+        else: # Flag that no correct Packet 2 header has been found
+            self.shared_telemetry_ring[slot_start:slot_start + self.telemetry_slot_length] = b"\x01" * self.telemetry_slot_length
+        self.shared_telemetry_write_count.value += 1 # Publish the slot to the main process
+
+def run_isolated_serial_exchange(*args): # Serial comms process target
+    IsolatedSerialExchange(*args).run()
+
 if __name__ =='__main__':
-    controller = NorthcliffAirconController(calibrate_damper_on_startup = False)
+    controller = NorthcliffAirconController(calibrate_damper_on_startup = False, isolate_serial_comms = False, aircon_comms_port = "/dev/ttyAMA0")
     controller.run()
     